@@ -0,0 +1,143 @@
+"""
+Background YOLO inference worker with request coalescing for GreenAI.
+
+Streamlit re-executes the whole script per interaction, so running the GPU
+forward on the script thread serializes all concurrent users. This module
+runs a single worker process that drains a request queue in small time
+windows and executes one batched forward per window, so N concurrent images
+cost roughly one forward instead of N. Image payloads travel through shared
+memory to avoid pickling megabytes per request.
+
+Enable by setting GREENAI_INFERENCE_WORKER=1 in the environment.
+"""
+
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+MAX_BATCH = 8
+MAX_WAIT_MS = 10
+
+_worker = None
+_request_queue = None
+_lock = threading.Lock()
+
+
+def enabled():
+    """Whether the out-of-process inference worker is switched on"""
+    return os.getenv("GREENAI_INFERENCE_WORKER", "0") == "1"
+
+
+def _drain(request_queue, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS):
+    """
+    Collect up to max_batch requests: block for the first one, then wait at
+    most max_wait_ms for stragglers so concurrent users coalesce into one
+    batched forward without adding latency when traffic is sparse.
+    """
+    batch = [request_queue.get()]
+    deadline = time.monotonic() + max_wait_ms / 1000.0
+    while len(batch) < max_batch:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(request_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+
+def _worker_loop(request_queue, model_path):
+    import torch
+    from ultralytics import YOLO
+
+    model = YOLO(model_path)
+    model.fuse()
+    use_cuda = torch.cuda.is_available()
+    model.predict(np.zeros((640, 640, 3), dtype=np.uint8), verbose=False)
+    names = model.names
+
+    while True:
+        batch = _drain(request_queue)
+
+        images, replies = [], []
+        for shm_name, shape, dtype, reply in batch:
+            shm = shared_memory.SharedMemory(name=shm_name)
+            images.append(np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf).copy())
+            shm.close()
+            replies.append(reply)
+
+        try:
+            results = model.predict(
+                images,
+                imgsz=640,
+                half=use_cuda,
+                device=0 if use_cuda else "cpu",
+                verbose=False,
+            )
+        except Exception as e:
+            for reply in replies:
+                reply.send(e)
+                reply.close()
+            continue
+
+        for result, reply in zip(results, replies):
+            boxes = result.boxes
+            bbox_arr = boxes.xyxy.round().cpu().numpy().astype(np.int32)
+            conf_arr = boxes.conf.cpu().numpy()
+            cls = boxes.cls.cpu().numpy().astype(int)
+            cls_arr = np.asarray([names[c] for c in cls], dtype=object)
+            reply.send((cls_arr, conf_arr, bbox_arr))
+            reply.close()
+
+
+def _ensure_worker(model_path="model.pt"):
+    global _worker, _request_queue
+    with _lock:
+        if _worker is not None and _worker.is_alive():
+            return
+        ctx = mp.get_context("spawn")
+        _request_queue = ctx.Queue()
+        _worker = ctx.Process(
+            target=_worker_loop, args=(_request_queue, model_path), daemon=True
+        )
+        _worker.start()
+
+
+def submit(img_array):
+    """
+    Run detection on img_array via the shared worker and return
+    (cls_arr, conf_arr, bbox_arr) parallel arrays. The image crosses the
+    process boundary through shared memory; only the small result arrays
+    are pickled back.
+    """
+    _ensure_worker()
+
+    shm = shared_memory.SharedMemory(create=True, size=img_array.nbytes)
+    try:
+        np.ndarray(img_array.shape, dtype=img_array.dtype, buffer=shm.buf)[:] = img_array
+        recv_end, send_end = mp.Pipe(duplex=False)
+        # Don't close send_end here: Queue.put hands the object to a feeder
+        # thread that pickles it later, and a closed Connection won't
+        # serialize. The worker closes its copy after replying.
+        _request_queue.put((shm.name, img_array.shape, str(img_array.dtype), send_end))
+
+        # Our own open send_end means the pipe never signals EOF, so a bare
+        # recv() would hang forever if the worker dies mid-batch (OOM, CUDA
+        # crash). Poll and check the worker is still there.
+        while not recv_end.poll(1.0):
+            if not _worker.is_alive():
+                raise RuntimeError("inference worker died before replying")
+        result = recv_end.recv()
+    finally:
+        shm.close()
+        shm.unlink()
+
+    if isinstance(result, Exception):
+        raise result
+    return result
@@ -2,41 +2,62 @@ import time
 import psutil
 import streamlit as st
 from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import REGISTRY
 from threading import Thread
 import http.server
-import socketserver
 
 # Prometheus metrics
 REQUEST_COUNT = Counter('streamlit_requests_total', 'Total requests', ['method', 'endpoint'])
 REQUEST_DURATION = Histogram('streamlit_request_duration_seconds', 'Request duration')
 ACTIVE_USERS = Gauge('streamlit_active_users', 'Number of active users')
-CPU_USAGE = Gauge('streamlit_cpu_usage_percent', 'CPU usage percentage')
-MEMORY_USAGE = Gauge('streamlit_memory_usage_bytes', 'Memory usage in bytes')
 YOLO_DETECTIONS = Counter('streamlit_yolo_detections_total', 'Total YOLO detections')
 GEMINI_API_CALLS = Counter('streamlit_gemini_api_calls_total', 'Total Gemini API calls', ['status'])
 
-class MetricsHandler(http.server.SimpleHTTPRequestHandler):
+# One process handle, reused so cpu_percent can diff against its prior sample
+_PROC = psutil.Process()
+
+class SystemCollector:
+    """
+    System metrics sampled lazily: collect() only runs when /metrics is
+    actually scraped, so there is no polling thread and zero cost while
+    nobody is looking. Metrics are per-process: in a container the
+    host-wide readings are meaningless for autoscaling and cost a /proc
+    walk over every core, while reading this process alone is one file.
+    """
+    def collect(self):
+        yield GaugeMetricFamily('streamlit_cpu_usage_percent', 'App CPU usage percentage',
+                                value=_PROC.cpu_percent(interval=None) / (psutil.cpu_count() or 1))
+        yield GaugeMetricFamily('streamlit_memory_usage_bytes', 'App resident memory in bytes',
+                                value=_PROC.memory_info().rss)
+
+REGISTRY.register(SystemCollector())
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    # BaseHTTPRequestHandler instead of SimpleHTTPRequestHandler: the
+    # filesystem-serving machinery was dead weight on a metrics-only port
+
+    def log_message(self, *args, **kwargs):
+        # Skip the stderr write syscall on every Prometheus scrape
+        pass
+
     def do_GET(self):
-        if self.path == '/metrics':
-            self.send_response(200)
-            self.send_header('Content-Type', CONTENT_TYPE_LATEST)
-            self.end_headers()
-            self.wfile.write(generate_latest())
-        else:
-            self.send_response(404)
-            self.end_headers()
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = generate_latest()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
 def start_metrics_server(port=8502):
     """Start Prometheus metrics server"""
-    handler = MetricsHandler
-    with socketserver.TCPServer(("", port), handler) as httpd:
+    # ThreadingHTTPServer so concurrent scrapes don't serialize
+    with http.server.ThreadingHTTPServer(("", port), MetricsHandler) as httpd:
         httpd.serve_forever()
 
-def update_system_metrics():
-    """Update system metrics"""
-    CPU_USAGE.set(psutil.cpu_percent())
-    MEMORY_USAGE.set(psutil.virtual_memory().used)
-
 def track_yolo_detection():
     """Track YOLO detection"""
     YOLO_DETECTIONS.inc()
@@ -58,13 +79,4 @@ def track_active_users():
 # Start metrics server in background thread
 def initialize_metrics():
     metrics_thread = Thread(target=start_metrics_server, daemon=True)
-    metrics_thread.start()
-    
-    # Update system metrics periodically
-    def update_metrics():
-        while True:
-            update_system_metrics()
-            time.sleep(10)
-    
-    system_metrics_thread = Thread(target=update_metrics, daemon=True)
-    system_metrics_thread.start()
\ No newline at end of file
+    metrics_thread.start()
\ No newline at end of file